@@ -4,7 +4,7 @@ import pandas as pd
 import numpy as np
 import random
 from .utils import meta_classes_selector, print_to_string_io, \
-    train_logger, val_logger, numpy_to_tensor, load_config
+    train_logger, val_logger, numpy_to_tensor, load_config, shard
 from torch.utils.data import Dataset, DataLoader
 from torchvision import transforms, utils, datasets
 from PIL import Image
@@ -110,6 +110,14 @@ class Datagenerator(Dataset):
         n_train_per_class = _config.n_train_per_class[self._data_type]
         n_val_per_class = _config.n_val_per_class[self._data_type]
         batch_size = _config.num_tasks[self._data_type]
+        if self._data_type == "meta_train":
+            # distributed processes sample their share of the tasks from
+            # their share of the classes, so classes are not repeated
+            classes = shard(classes)
+            batch_size = len(shard(range(batch_size)))
+            if batch_size == 0:
+                raise ValueError("number of tasks must be at least the number \
+                                 of distributed processes")
         img_datasets = datasets.ImageFolder(root=os.path.join(
             dataset_root_path, "images"))
 
@@ -202,6 +210,28 @@ class Datagenerator(Dataset):
         return self.__getitem__(0)
 
 
+class ValidationData(Dataset):
+    """Loads the validation images and masks of a task from their paths
+
+    Args:
+        img_paths (list): paths of the validation images
+        mask_paths (list): paths of the validation masks
+        transformers (tuple): tuple of image and mask transformers
+    """
+    def __init__(self, img_paths, mask_paths, transformers):
+        self.img_paths = img_paths
+        self.mask_paths = mask_paths
+        self.transform_image, self.transform_mask = transformers
+
+    def __len__(self):
+        return len(self.img_paths)
+
+    def __getitem__(self, idx):
+        img = self.transform_image(Image.open(self.img_paths[idx]))
+        mask = self.transform_mask(Image.open(self.mask_paths[idx]))
+        return img, mask
+
+
 class TrainingStats:
     """ Stores train statistics data """
     def __init__(self):
@@ -1,36 +1,79 @@
 import os
+import copy
+import contextlib
 import torch
 import gc
-import numpy as np
+from itertools import chain, islice
 from torch import nn
 from torch.distributions import Normal
 from torch.nn import CrossEntropyLoss
 from torchvision import models
 from torch.nn import functional as F
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from torch.utils.data import DataLoader
+from torch.utils.checkpoint import checkpoint
 from tqdm import tqdm
+from .data import ValidationData
 from .utils import display_data_shape, get_named_dict, calc_iou_per_class,\
-    log_data, load_config, list_to_tensor, numpy_to_tensor, tensor_to_numpy,\
-    prepare_inputs
+    log_data, load_config, prepare_inputs, all_reduce_grads,\
+    average_buffers, broadcast_tensors, get_device, list_checkpoints
+
+
+_mobilenet_v2_features = None
+
+
+def pretrained_mobilenet_v2_features():
+    """ Returns the pretrained MobileNetV2 feature layers
+        The weights are loaded once per process and copied for each encoder
+    """
+    global _mobilenet_v2_features
+    if _mobilenet_v2_features is None:
+        _mobilenet_v2_features = models.mobilenet_v2(
+            weights=models.MobileNet_V2_Weights.IMAGENET1K_V1).features
+    return copy.deepcopy(_mobilenet_v2_features)
 
 
 class EncoderBlock(nn.Module):
     """ Encoder with pretrained backbone """
+    # layers whose outputs feed the decoder skip connections
+    output_layers = frozenset([1, 3, 6, 13])
+
     def __init__(self):
         super(EncoderBlock, self).__init__()
-        self.layers = nn.ModuleList(list(models.mobilenet_v2(pretrained=True)
-                                    .features))
+        self.layers = nn.ModuleList(list(pretrained_mobilenet_v2_features()))
     
     def forward(self, x):
         features = []
-        output_layers = [1, 3, 6, 13]
         for i, layer in enumerate(self.layers):
             x = layer(x)
-            if i in output_layers:
+            if i in self.output_layers:
                 features.append(x)
         features.append(x)
         return features
 
 
+def icnr_(weight, scale=2, init=nn.init.kaiming_normal_):
+    """ Initializes the kernel of a sub-pixel convolution with ICNR
+        Every group of scale**2 output channels starts out identical,
+        so the shuffled output is free of checkerboard artifacts
+    """
+    out_channels, *kernel_shape = weight.shape
+    sub_kernel = torch.empty(out_channels // scale**2, *kernel_shape)
+    init(sub_kernel)
+    with torch.no_grad():
+        weight.copy_(sub_kernel.repeat_interleave(scale**2, dim=0))
+    return weight
+
+
+def upsample_block(in_channels, out_channels, scale=2):
+    """ Sub-pixel convolution upsampling features by scale """
+    conv = nn.Conv2d(in_channels, out_channels*scale**2, kernel_size=1)
+    icnr_(conv.weight, scale)
+    nn.init.zeros_(conv.bias)
+    return nn.Sequential(conv, nn.PixelShuffle(scale))
+
+
 def decoder_block(conv_in_size, conv_out_size):
     """ Sequentical group formimg a decoder block """
     layers = [
@@ -42,13 +85,36 @@ def decoder_block(conv_in_size, conv_out_size):
               nn.Conv2d(conv_out_size, conv_out_size,
                         kernel_size=3, stride=1, padding=1),
               nn.ReLU(),
-              nn.ConvTranspose2d(conv_out_size, conv_out_size,
-                                 kernel_size=4, stride=2, padding=1)
+              upsample_block(conv_out_size, conv_out_size)
              ]
     conv_block = nn.Sequential(*layers)
     return conv_block
 
 
+def skip_stage(skip_proj, conv, o, skip):
+    """ Adds the projected skip features and runs the next decoder block """
+    return conv(o + skip_proj(skip))
+
+
+@contextlib.contextmanager
+def frozen_running_stats(module):
+    """ Keeps the BatchNorm running statistics of a module unchanged
+        Checkpointed stages run their forward pass again in the backward
+        pass, which must not update the running statistics a second time
+    """
+    batchnorms = [m for m in module.modules()
+                  if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    saved = [(m.momentum, m.num_batches_tracked.clone()) for m in batchnorms]
+    for m in batchnorms:
+        m.momentum = 0.0
+    try:
+        yield
+    finally:
+        for m, (momentum, num_batches_tracked) in zip(batchnorms, saved):
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(num_batches_tracked)
+
+
 class DecoderBlock(nn.Module):
     """
     Leo Decoder
@@ -57,28 +123,84 @@ class DecoderBlock(nn.Module):
         super(DecoderBlock, self).__init__()
         self.conv1 = decoder_block(encoder_outputs[-1].shape[1],
                                    hyp.base_num_covs*1)
-        self.conv2 = decoder_block(encoder_outputs[-2].shape[1] + hyp.base_num_covs*1, 
-                                   hyp.base_num_covs*2)
-        self.conv3 = decoder_block(encoder_outputs[-3].shape[1] + hyp.base_num_covs*2,
-                                   hyp.base_num_covs*3)
-        self.conv4 = decoder_block(encoder_outputs[-4].shape[1] + hyp.base_num_covs*3,
-                                   hyp.base_num_covs*4)
-        self.up_final = nn.ConvTranspose2d(encoder_outputs[-5].shape[1] + hyp.base_num_covs*4,
-                                   hyp.base_num_covs*5, kernel_size=4, stride=2, padding=1)
-        
+        self.skip_proj1 = nn.Conv2d(encoder_outputs[-2].shape[1],
+                                    hyp.base_num_covs*1, kernel_size=1)
+        self.conv2 = decoder_block(hyp.base_num_covs*1, hyp.base_num_covs*2)
+        self.skip_proj2 = nn.Conv2d(encoder_outputs[-3].shape[1],
+                                    hyp.base_num_covs*2, kernel_size=1)
+        self.conv3 = decoder_block(hyp.base_num_covs*2, hyp.base_num_covs*3)
+        self.skip_proj3 = nn.Conv2d(encoder_outputs[-4].shape[1],
+                                    hyp.base_num_covs*3, kernel_size=1)
+        self.conv4 = decoder_block(hyp.base_num_covs*3, hyp.base_num_covs*4)
+        self.skip_proj4 = nn.Conv2d(encoder_outputs[-5].shape[1],
+                                    hyp.base_num_covs*4, kernel_size=1)
+        self.up_final = upsample_block(hyp.base_num_covs*4,
+                                       hyp.base_num_covs*5)
+
+    def run_stage(self, stage, *inputs):
+        """ Runs a decoder stage. While training with checkpointing enabled
+            only the stage inputs are stored and its activations are
+            recomputed in the backward pass, with the BatchNorm running
+            statistics frozen
+        """
+        if config.checkpoint_decoder and self.training \
+           and torch.is_grad_enabled():
+            return checkpoint(stage, *inputs, use_reentrant=False,
+                              context_fn=lambda: (contextlib.nullcontext(),
+                                                  frozen_running_stats(self)))
+        return stage(*inputs)
+
     def forward(self, encoder_outputs):
-        o = self.conv1(encoder_outputs[-1])
-        o = torch.cat([o, encoder_outputs[-2]], dim=1)
-        o = self.conv2(o)
-        o = torch.cat([o, encoder_outputs[-3]], dim=1)
-        o = self.conv3(o)
-        o = torch.cat([o, encoder_outputs[-4]], dim=1)
-        o = self.conv4(o)
-        o = torch.cat([o, encoder_outputs[-5]], dim=1)
-        o = self.up_final(o)
+        # skip connections are projected and added to the upsampled features
+        o = self.run_stage(self.conv1, encoder_outputs[-1])
+        o = self.run_stage(skip_stage, self.skip_proj1, self.conv2,
+                           o, encoder_outputs[-2])
+        o = self.run_stage(skip_stage, self.skip_proj2, self.conv3,
+                           o, encoder_outputs[-3])
+        o = self.run_stage(skip_stage, self.skip_proj3, self.conv4,
+                           o, encoder_outputs[-4])
+        o = self.run_stage(skip_stage, self.skip_proj4, self.up_final,
+                           o, encoder_outputs[-5])
         return o
 
 
+class InferenceBackbone(nn.Module):
+    """ Chains the encoder and decoder into a single module for inference """
+    def __init__(self, encoder, decoder):
+        super(InferenceBackbone, self).__init__()
+        self.encoder = encoder
+        self.decoder = decoder
+
+    def forward(self, x):
+        return self.decoder(self.encoder(x))
+
+
+def quantize_encoder(encoder, calibration_imgs):
+    """ Applies post-training static INT8 quantization to the encoder
+        Quantized kernels only run on cpu
+        Args:
+            encoder (nn.Module): encoder in eval mode
+            calibration_imgs (torch.Tensor): images used to calibrate the
+                activation ranges
+        Returns:
+            encoder (nn.Module): quantized encoder
+    """
+    prepared = prepare_fx(encoder, get_default_qconfig_mapping(),
+                          example_inputs=(calibration_imgs,))
+    with torch.no_grad():
+        prepared(calibration_imgs)
+    return convert_fx(prepared)
+
+
+def compile_module(module):
+    """ Compiles a module in place with torch.compile if enabled in config
+        Compiling in place keeps the state dict keys of the module unchanged
+    """
+    if config.compile_model:
+        module.compile()
+    return module
+
+
 class LEO(nn.Module):
     """
     contains functions to perform latent embedding optimization
@@ -88,23 +210,103 @@ class LEO(nn.Module):
         self.mode = mode
         img_dims = config.data_params.img_dims
         self.img_dims = (img_dims.channels, img_dims.height, img_dims.width)
-        self.encoder = EncoderBlock()
-        self.device = torch.device("cuda:0" if torch.cuda.is_available()
-                                   and config.use_gpu else "cpu")
+        encoder = EncoderBlock()
+        # the decoder is sized from the encoder outputs of a dummy image
+        encoder.eval()
+        with torch.no_grad():
+            encoder_outputs = encoder(torch.zeros(1, *self.img_dims))
+        encoder.train()
+        self.encoder = compile_module(encoder)
+        self.decoder = compile_module(DecoderBlock(encoder_outputs))
+        self.device = get_device()
         seg_network = nn.Conv2d(hyp.base_num_covs*5 + 3, 2, kernel_size=3, stride=1, padding=1)
-        self.seg_weight = seg_network.weight.detach().to(self.device)
-        self.seg_weight.requires_grad = True
+        self.seg_weight = nn.Parameter(seg_network.weight.detach().clone())
         self.loss_fn = CrossEntropyLoss()
-        self.optimizer_seg_network = torch.optim.Adam(
-            [self.seg_weight], lr=hyp.outer_loop_lr)
+        self.to(self.device, memory_format=torch.channels_last)
+        # start every distributed process from the same weights
+        broadcast_tensors(list(self.decoder.state_dict().values())
+                          + [self.seg_weight])
+        self.copy_stream = torch.cuda.Stream(self.device) \
+            if self.device.type == "cuda" else None
+        self._decoder_params = list(self.decoder.parameters())
+        # the fused kernel updates all outer loop parameters in one launch
+        self.optimizer = torch.optim.Adam(
+            self._decoder_params + [self.seg_weight], lr=hyp.outer_loop_lr,
+            fused=self.device.type == "cuda")
 
     def freeze_encoder(self):
         """ Freeze encoder weights """
         for param in self.encoder.parameters():
             param.requires_grad = False
 
+    def inference_backbone(self, example_input):
+        """ Freezes a copy of the encoder and decoder for evaluation
+            The copy is traced and optimized for inference, which folds
+            BatchNorm into the convolutions and removes Dropout. On cpu the
+            encoder can also be quantized to INT8
+            Args:
+                example_input (torch.Tensor): input images used for tracing
+            Returns:
+                backbone (nn.Module): maps input images to decoder features
+        """
+        backbone = copy.deepcopy(InferenceBackbone(self.encoder,
+                                                   self.decoder)).eval()
+        # the copied modules share the compiled call of the live modules,
+        # which would run them in train mode
+        backbone.encoder._compiled_call_impl = None
+        backbone.decoder._compiled_call_impl = None
+        if config.quantize_encoder and self.device.type == "cpu":
+            backbone.encoder = quantize_encoder(backbone.encoder,
+                                                example_input)
+        if config.compile_model:
+            return compile_module(backbone)
+        with torch.no_grad():
+            traced = torch.jit.trace(backbone, example_input)
+        return torch.jit.optimize_for_inference(traced)
+
+    def prefetch(self, loader):
+        """ Yields the batches of a loader moved to the device
+            On cuda the next batch is copied on a side stream while the
+            current batch is being processed
+            Args:
+                loader (DataLoader): loader yielding lists of tensors
+        """
+        if self.copy_stream is None:
+            for batch in loader:
+                yield [data.to(self.device) for data in batch]
+            return
+
+        def to_device(batch):
+            with torch.cuda.stream(self.copy_stream):
+                return [data.to(self.device, non_blocking=True)
+                        for data in batch]
+
+        batches = iter(loader)
+        next_batch = next(batches, None)
+        if next_batch is not None:
+            next_batch = to_device(next_batch)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.copy_stream)
+            batch = next_batch
+            for data in batch:
+                data.record_stream(current_stream)
+            next_batch = next(batches, None)
+            if next_batch is not None:
+                next_batch = to_device(next_batch)
+            yield batch
+
+    def autocast(self):
+        """ Returns a bfloat16 autocast context, enabled for mixed precision
+            on cuda
+        """
+        return torch.autocast(self.device.type, dtype=torch.bfloat16,
+                              enabled=config.mixed_precision
+                              and self.device.type == "cuda")
+
     def forward_encoder(self, x):
         """ Performs forward pass through the encoder """
+        x = x.contiguous(memory_format=torch.channels_last)
         encoder_outputs = self.encoder(x)
         if not encoder_outputs[-1].requires_grad:
             encoder_outputs[-1].requires_grad = True
@@ -115,10 +317,44 @@ class LEO(nn.Module):
         output = self.decoder(encoder_outputs)
         return output
 
+    def forward_task_encoder(self, x, num_tasks):
+        """ Performs a forward pass through the encoder for each task
+            BatchNorm normalizes over the examples of a single task, so the
+            outputs of a task do not depend on the other tasks
+            Args:
+                x (torch.Tensor): input images of all tasks stacked along the
+                    batch dimension
+                num_tasks (int): number of tasks in the batch
+            Returns:
+                encoder_outputs (list): encoder outputs of all tasks stacked
+                    along the batch dimension
+        """
+        task_outputs = [self.forward_encoder(task_x)
+                        for task_x in x.chunk(num_tasks)]
+        return [torch.cat(outputs) for outputs in zip(*task_outputs)]
+
+    def forward_task_decoder(self, encoder_outputs, num_tasks):
+        """ Performs a forward pass through the decoder for each task
+            BatchNorm normalizes over the examples of a single task, so the
+            features of a task do not depend on the other tasks
+            Args:
+                encoder_outputs (list): encoder outputs of all tasks stacked
+                    along the batch dimension
+                num_tasks (int): number of tasks in the batch
+            Returns:
+                features (torch.Tensor): decoder features of all tasks
+                    (num_tasks * num_examples, channels, height, width)
+        """
+        task_outputs = zip(*[output.chunk(num_tasks)
+                             for output in encoder_outputs])
+        return torch.cat([self.forward_decoder(list(outputs))
+                          for outputs in task_outputs])
+
     def forward_segnetwork(self, decoder_out, x, weight):
         """  Receives features from the decoder
-             Concats the features with input image
-             Convolution layer acts on the concatenated input
+             Convolution layer acts on the features and the input image
+             The kernels are split along their input channels, which equals
+             convolving the concatenated input without materializing it
             Args:
                 decoder_out (torch.Tensor): decoder output features
                 x (torch.Tensor): input images
@@ -126,10 +362,40 @@ class LEO(nn.Module):
             Returns:
                 pred(tf.tensor): predicted logits
         """
-        o = torch.cat([decoder_out, x], dim=1)
-        pred = F.conv2d(o, weight, padding=1)
+        num_img_channels = x.shape[1]
+        pred = F.conv2d(decoder_out, weight[:, :-num_img_channels], padding=1)\
+            + F.conv2d(x, weight[:, -num_img_channels:], padding=1)
         return pred
 
+    def forward_task_segnetwork(self, decoder_out, x, weights):
+        """  Segments the features of every task with the task's own kernels
+             Tasks are folded into the channel dimension and segmented by
+             a grouped convolution with one group per task
+            Args:
+                decoder_out (torch.Tensor): decoder output features
+                    (num_tasks, num_examples, channels, height, width)
+                x (torch.Tensor): input images
+                    (num_tasks, num_examples, channels, height, width)
+                weights(torch.Tensor): kernels for the segmentation network
+                    (num_tasks, 2, channels, 3, 3)
+            Returns:
+                pred(torch.Tensor): predicted logits
+                    (num_tasks, num_examples, 2, height, width)
+        """
+        num_tasks, num_examples, num_img_channels = x.shape[:3]
+
+        def task_conv(inputs, task_weights):
+            inputs = inputs.transpose(0, 1).reshape(num_examples, -1,
+                                                    *inputs.shape[3:])
+            return F.conv2d(inputs,
+                            task_weights.reshape(-1, *task_weights.shape[2:]),
+                            padding=1, groups=num_tasks)
+
+        pred = task_conv(decoder_out, weights[:, :, :-num_img_channels])\
+            + task_conv(x, weights[:, :, -num_img_channels:])
+        pred = pred.view(num_examples, num_tasks, -1, *pred.shape[2:])
+        return pred.transpose(0, 1)
+
     def forward(self, x, latents=None, weight=None):
         """ Performs a forward pass through the entire network
             - The Autoencoder generates features using the inputs
@@ -158,84 +424,190 @@ class LEO(nn.Module):
         pred = self.forward_segnetwork(features, x, seg_weight)
         return latents, features, pred
     
+    def task_losses(self, pred, y, num_tasks):
+        """ Computes the cross entropy loss of each task in a batch
+            Args:
+                pred(torch.Tensor): predicted logits of all tasks
+                    (num_tasks * num_examples, 2, height, width)
+                y(torch.Tensor): masks of all tasks
+                    (num_tasks * num_examples, height, width)
+                num_tasks(int): number of tasks in the batch
+            Returns:
+                losses(torch.Tensor): mean loss of each task (num_tasks,)
+        """
+        losses = F.cross_entropy(pred, y, reduction="none")
+        return losses.view(num_tasks, -1).mean(dim=1)
+
     def leo_inner_loop(self, x, y):
-        """ Performs innerloop optimization
+        """ Performs innerloop optimization for all tasks at once
+            - Tasks are stacked along the batch dimension. The encoder and
+              decoder run per task, which keeps their BatchNorm statistics
+              within a task
             - It updates the latents taking gradients wrt the training loss
             - It generates better features after the latents are updated
 
             Args:
-                x(torch.Tensor): input training image
-                y(torch.Tensor): input training mask
+                x(torch.Tensor): input training images
+                    (num_tasks, num_examples, channels, height, width)
+                y(torch.Tensor): input training masks
+                    (num_tasks, num_examples, height, width)
 
             Returns:
-                seg_weight_grad(torch.Tensor): The last gradient of the
-                    training loss wrt to the segmenation weights
+                seg_weight_grads(torch.Tensor): The last gradient of each
+                    task's training loss wrt to the segmenation weights
+                    (num_tasks, 2, channels, 3, 3)
                 features(torch.Tensor): The last generated features
-        """    
+                    (num_tasks, num_examples, channels, height, width)
+        """
         inner_lr = hyp.inner_loop_lr
-        latents, _, pred = self.forward(x)
-        tr_loss = self.loss_fn(pred, y.long())
+        num_tasks, num_examples = x.shape[:2]
+        task_x = x
+        x = x.reshape(-1, *x.shape[2:])
+        y = y.reshape(-1, *y.shape[2:]).long()
+        # the encoder outputs do not change between adaptation steps, only
+        # the latents do, so the encoder runs once
+        encoder_outputs = self.forward_task_encoder(x, num_tasks)
+        # the latents are updated in float32, bfloat16 would round the small
+        # updates away. Autocast still lowers the decoder computations
+        latents = encoder_outputs[-1].float().detach().requires_grad_()
+        features = self.forward_task_decoder(encoder_outputs[:-1] + [latents],
+                                             num_tasks)
         for _ in range(hyp.num_adaptation_steps):
-            latents_grad = torch.autograd.grad(tr_loss, [latents],
+            pred = self.forward_segnetwork(features, x, self.seg_weight)
+            tr_loss = self.task_losses(pred, y, num_tasks)
+            # the loss of a task only depends on its own latents, hence the
+            # gradient of the summed loss is the gradient of each task's loss
+            latents_grad = torch.autograd.grad(tr_loss.sum(), [latents],
                                                create_graph=False)[0]
             with torch.no_grad():
                 latents -= inner_lr * latents_grad
-            latents, features, pred = self.forward(x, latents)
-            tr_loss = self.loss_fn(pred, y.long())
-        seg_weight_grad = torch.autograd.grad(tr_loss, [self.seg_weight],
-                                              create_graph=False)[0]
-        return seg_weight_grad, features
-
-    def finetuning_inner_loop(self, data_dict, tr_features, seg_weight_grad,
-                              transformers, mode):
-        """ Finetunes the segmenation weights/kernels by performing MAML
+            features = self.forward_task_decoder(
+                encoder_outputs[:-1] + [latents], num_tasks)
+        features = features.reshape(num_tasks, num_examples,
+                                    *features.shape[1:])
+        # every task segments with its own view of the kernels, so a single
+        # backward pass gives the gradient of each task's loss
+        seg_weights = self.seg_weight.expand(num_tasks,
+                                             *self.seg_weight.shape)
+        pred = self.forward_task_segnetwork(features, task_x, seg_weights)
+        tr_loss = self.task_losses(pred.reshape(-1, *pred.shape[2:]), y,
+                                   num_tasks)
+        seg_weight_grads = torch.autograd.grad(tr_loss.sum(), [seg_weights],
+                                               create_graph=False)[0]
+        # finetuning only differentiates wrt the segmentation weights
+        return seg_weight_grads, features.detach()
+
+    def finetuning_inner_loop(self, tr_imgs, tr_masks, tr_features,
+                              seg_weight_grads):
+        """ Finetunes the segmenation weights/kernels of all tasks at once
+            by performing MAML
             Args:
-                data_dict (dict): contains tr_imgs, tr_masks, val_imgs, val_masks
+                tr_imgs (torch.Tensor): input training images
+                    (num_tasks, num_examples, channels, height, width)
+                tr_masks (torch.Tensor): input training masks
+                    (num_tasks, num_examples, height, width)
                 tr_features (torch.Tensor): tensor containing decoder features
-                segmentation_grad (torch.Tensor): gradients of the training
-                                                loss to the segmenation weights
+                    (num_tasks, num_examples, channels, height, width)
+                seg_weight_grads (torch.Tensor): gradients of each task's
+                    training loss to the segmenation weights
+            Returns:
+                weights (torch.Tensor): finetuned segmentation weights
+                    (num_tasks, 2, channels, 3, 3)
+        """
+        num_tasks = tr_imgs.shape[0]
+        y = tr_masks.reshape(-1, *tr_masks.shape[2:]).long()
+        weights = self.seg_weight - hyp.finetuning_lr * seg_weight_grads
+        for _ in range(hyp.num_finetuning_steps - 1):
+            pred = self.forward_task_segnetwork(tr_features, tr_imgs, weights)
+            tr_loss = self.task_losses(pred.reshape(-1, *pred.shape[2:]), y,
+                                       num_tasks)
+            # each task's kernels only see that task's loss
+            seg_weight_grads = torch.autograd.grad(tr_loss.sum(), [weights],
+                                                   create_graph=False)[0]
+            weights -= hyp.finetuning_lr * seg_weight_grads
+        return weights
+
+    def validation_loader(self, img_paths, mask_paths, transformers):
+        """ Builds a single loader over the validation data of all tasks
+            Batches never mix tasks, so the workers are started once for
+            all tasks
+            Args:
+                img_paths (list): validation image paths of each task
+                mask_paths (list): validation mask paths of each task
+                transformers(tuple): tuple of image and mask transformers
+            Returns:
+                val_loader (DataLoader): loader yielding the batches of the
+                    tasks in order
+                num_batches (list): number of batches of each task
+        """
+        batch_size = config.data_params.val_batch_size
+        batches, num_batches, start = [], [], 0
+        for paths in img_paths:
+            indices = range(start, start + len(paths))
+            task_batches = [indices[i:i + batch_size]
+                            for i in range(0, len(indices), batch_size)]
+            batches.extend(task_batches)
+            num_batches.append(len(task_batches))
+            start += len(paths)
+        val_data = ValidationData(list(chain(*img_paths)),
+                                  list(chain(*mask_paths)), transformers)
+        val_loader = DataLoader(val_data, batch_sampler=batches,
+                                num_workers=config.data_params.num_workers,
+                                pin_memory=self.device.type == "cuda")
+        return val_loader, num_batches
+
+    def validate_task(self, data_dict, weight, mode, backbone=None,
+                      val_batches=None):
+        """ Evaluates the finetuned segmenation weights of a task
+            Args:
+                data_dict (dict): contains tr_imgs, tr_masks, val_imgs, val_masks
+                weight (torch.Tensor): finetuned segmentation weights
+                mode(str): meta_train, meta_val or meta_test
+                backbone(nn.Module): frozen encoder and decoder used
+                    outside of meta_train
+                val_batches(iterable): validation batches of the task on the
+                    device, used outside of meta_train
             Returns:
                 val_loss (torch.Tensor): validation loss
                 seg_weight_grad (torch.Tensor): gradient of validation loss
                                                 wrt segmentation weights
                 decoder_grads (torch.Tensor): gradient of validation loss
                                                 wrt decoder weights
-                transformers(tuple): tuple of image and mask transformers
+                mean_iou (float): mean iou of the validation masks
                 weight (torch.Tensor): segmentation weights
         """
-        img_transformer, mask_transformer = transformers
-        weight = self.seg_weight - hyp.finetuning_lr * seg_weight_grad
-        for _ in range(hyp.num_finetuning_steps - 1):
-            pred = self.forward_segnetwork(tr_features, data_dict.tr_imgs, weight)
-            tr_loss = self.loss_fn(pred, data_dict.tr_masks.long())
-            seg_weight_grad = torch.autograd.grad(tr_loss, [weight],
-                                                  create_graph=False)[0]
-            weight -= hyp.finetuning_lr * seg_weight_grad
-
         if mode == "meta_train":
             _, _, prediction = self.forward(data_dict.val_imgs, weight=weight)
             val_loss = self.loss_fn(prediction, data_dict.val_masks.long())
             grad_output = torch.autograd.grad(val_loss,
-                [weight] + list(self.decoder.parameters()), create_graph=False)
+                [weight] + self._decoder_params, create_graph=False)
             seg_weight_grad, decoder_grads = grad_output[0], grad_output[1:]
-            mean_iou = calc_iou_per_class(prediction, data_dict.val_masks)
+            mean_iou = calc_iou_per_class(prediction,
+                                          data_dict.val_masks).item()
             return val_loss, seg_weight_grad, decoder_grads, mean_iou, weight
         else:
-            with torch.no_grad():
+            with torch.inference_mode():
                 mean_ious = []
                 val_losses = []
-                val_img_paths = data_dict.val_imgs
-                val_mask_paths = data_dict.val_masks
-                for _img_path, _mask_path in tqdm(zip(val_img_paths, val_mask_paths)):
-                    input_img = prepare_inputs(numpy_to_tensor(list_to_tensor(_img_path, img_transformer)))
-                    input_mask = numpy_to_tensor(list_to_tensor(_mask_path, mask_transformer))
-                    _, _, prediction = self.forward(input_img, weight=weight)
-                    val_loss = self.loss_fn(prediction, input_mask.long()).item()
+                batch_sizes = []
+                for input_img, input_mask in val_batches:
+                    input_img = prepare_inputs(input_img)
+                    features = backbone(input_img)
+                    prediction = self.forward_segnetwork(features, input_img,
+                                                         weight)
+                    # losses and ious stay on the device until all batches
+                    # are done
+                    val_loss = self.loss_fn(prediction, input_mask.long())
                     mean_iou = calc_iou_per_class(prediction, input_mask)
-                    mean_ious.append(mean_iou)
-                    val_losses.append(val_loss)
-                mean_iou = np.mean(mean_ious)
-                val_loss = np.mean(val_losses)
+                    mean_ious.append(mean_iou*len(input_img))
+                    val_losses.append(val_loss*len(input_img))
+                    batch_sizes.append(len(input_img))
+                # a class may have no images left for validation
+                if not batch_sizes:
+                    return float("nan"), None, None, float("nan"), weight
+                val_loss, mean_iou = (torch.stack([
+                    torch.stack(val_losses).sum(),
+                    torch.stack(mean_ious).sum()]) / sum(batch_sizes)).tolist()
             return val_loss, None, None, mean_iou, weight
         
     def compute_loss(self, metadata, train_stats, transformers, mode="meta_train"):
@@ -250,48 +622,63 @@ class LEO(nn.Module):
                 total_val_loss(float32): meta-validation loss
                 train_stats(object): object that stores training statistics
         """
-        num_tasks = len(metadata[0])
-        # initialize decoder on the first episode
-        if train_stats.episode == 1:
-            data = get_named_dict(metadata, 0)
-            encoder_output = self.forward_encoder(data.tr_imgs)
-            self.decoder = DecoderBlock(encoder_output).to(self.device)
-            self.optimizer_decoder = torch.optim.Adam(
-              self.decoder.parameters(), lr=hyp.outer_loop_lr)
-
+        # distributed processes only load their share of the tasks, the
+        # gradients are averaged over the tasks of all processes
+        num_tasks = config.data_params.num_tasks[mode]
         if train_stats.episode % config.display_stats_interval == 1:
             display_data_shape(metadata)
         classes = metadata[4]
         total_val_loss = []
         mean_iou_dict = {}
         total_grads = None
-        for batch in range(num_tasks):
-            data = get_named_dict(metadata, batch)
-            seg_weight_grad, features = self.leo_inner_loop(data.tr_imgs, data.tr_masks)
-            val_loss, seg_weight_grad, decoder_grads, mean_iou, _ = \
-                self.finetuning_inner_loop(data, features, seg_weight_grad,
-                                           transformers, mode)
+        tr_imgs, tr_masks = prepare_inputs(metadata[0]), metadata[1]
+        # parameters stay in float32, autocast only lowers the activations
+        with self.autocast():
+            seg_weight_grads, features = self.leo_inner_loop(tr_imgs,
+                                                             tr_masks)
+            weights = self.finetuning_inner_loop(tr_imgs, tr_masks, features,
+                                                 seg_weight_grads)
+        tasks_data = [get_named_dict(metadata, batch)
+                      for batch in range(len(classes))]
+        if mode == "meta_train":
+            backbone = None
+            tasks_batches = [None] * len(classes)
+        else:
+            backbone = self.inference_backbone(tr_imgs[0])
+            val_loader, num_batches = self.validation_loader(
+                metadata[2], metadata[3], transformers)
+            val_batches = iter(tqdm(self.prefetch(val_loader),
+                                    total=len(val_loader)))
+            # tasks consume the batches of the shared loader in order
+            tasks_batches = [islice(val_batches, task_num_batches)
+                             for task_num_batches in num_batches]
+        for batch, data in enumerate(tasks_data):
+            with self.autocast():
+                val_loss, seg_weight_grad, decoder_grads, mean_iou, _ = \
+                    self.validate_task(data, weights[batch], mode, backbone,
+                                       tasks_batches[batch])
             if mode == "meta_train":
-                decoder_grads = [grad/num_tasks for grad in decoder_grads]
                 if total_grads is None:
-                    total_grads = decoder_grads
-                    seg_weight_grad = seg_weight_grad/num_tasks
+                    total_grads = [grad/num_tasks for grad in decoder_grads]
+                    total_seg_weight_grad = seg_weight_grad/num_tasks
                 else:
-                    total_grads = [total_grads[i] + decoder_grads[i]\
-                                   for i in range(len(decoder_grads))]
-                    seg_weight_grad += seg_weight_grad/num_tasks
+                    for total_grad, grad in zip(total_grads, decoder_grads):
+                        total_grad.add_(grad, alpha=1/num_tasks)
+                    total_seg_weight_grad.add_(seg_weight_grad,
+                                               alpha=1/num_tasks)
             mean_iou_dict[classes[batch]] = mean_iou
             total_val_loss.append(val_loss)
 
         if mode == "meta_train":
-            self.optimizer_decoder.zero_grad()
-            self.optimizer_seg_network.zero_grad()
-            
-            for i, params in enumerate(self.decoder.parameters()):
-                params.grad = total_grads[i]
-            self.seg_weight.grad = seg_weight_grad
-            self.optimizer_decoder.step()
-            self.optimizer_seg_network.step()
+            all_reduce_grads(total_grads + [total_seg_weight_grad])
+            self.optimizer.zero_grad(set_to_none=True)
+            for params, grad in zip(self._decoder_params, total_grads):
+                params.grad = grad
+            self.seg_weight.grad = total_seg_weight_grad
+            self.optimizer.step()
+            # processes trained on different tasks, hence their BatchNorm
+            # running statistics differ
+            average_buffers(list(self.buffers()))
         total_val_loss = float(sum(total_val_loss)/len(total_val_loss))
         stats_data = {
             "mode": mode,
@@ -302,6 +689,76 @@ class LEO(nn.Module):
         return total_val_loss, train_stats
 
 
+def stage_to_host(data):
+    """
+    Copies the cuda tensors of nested dicts and lists into pinned host
+    buffers, one per dtype
+
+    All copies are issued asynchronously and synchronized once. The
+    returned tensors are views of the buffer of their dtype and keep the
+    strides of the cuda tensors they were copied from. torch.save
+    keeps a single dtype per storage, hence tensors of different dtypes
+    never share a buffer.
+
+    Args:
+        data - checkpoint data, e.g. nested state dicts
+
+    Returns:
+        data with cuda tensors replaced by host tensors
+    """
+    tensors = {}
+
+    def collect(obj):
+        if torch.is_tensor(obj):
+            if obj.is_cuda:
+                tensors[id(obj)] = obj
+        elif isinstance(obj, dict):
+            for value in obj.values():
+                collect(value)
+        elif isinstance(obj, (list, tuple)):
+            for value in obj:
+                collect(value)
+
+    collect(data)
+    if not tensors:
+        return data
+
+    offsets, sizes = {}, {}
+    for key, tensor in tensors.items():
+        offsets[key] = sizes.get(tensor.dtype, 0)
+        sizes[tensor.dtype] = offsets[key] + tensor.numel()
+    staging = {dtype: torch.empty(size, dtype=dtype, pin_memory=True)
+               for dtype, size in sizes.items()}
+    host_tensors = {}
+    for key, tensor in tensors.items():
+        slot = staging[tensor.dtype][offsets[key]:offsets[key] + tensor.numel()]
+        # dense tensors keep their strides, e.g. channels_last weights and
+        # the optimizer states that inherit their layout
+        if tensor.is_contiguous() or \
+           tensor.is_contiguous(memory_format=torch.channels_last):
+            host_tensor = slot.as_strided(tensor.shape, tensor.stride())
+        else:
+            host_tensor = slot.view(tensor.shape)
+        host_tensor.copy_(tensor, non_blocking=True)
+        host_tensors[key] = host_tensor
+    torch.cuda.synchronize()
+
+    def replace(obj):
+        if torch.is_tensor(obj):
+            return host_tensors.get(id(obj), obj)
+        elif isinstance(obj, dict):
+            replaced = type(obj)((k, replace(v)) for k, v in obj.items())
+            # state dicts carry version metadata used when loading
+            if hasattr(obj, "_metadata"):
+                replaced._metadata = obj._metadata
+            return replaced
+        elif isinstance(obj, (list, tuple)):
+            return type(obj)(replace(value) for value in obj)
+        return obj
+
+    return replace(data)
+
+
 def save_model(model, optimizer, config, stats):
     """
     Save the model while training based on check point interval
@@ -319,11 +776,13 @@ def save_model(model, optimizer, config, stats):
     
     Returns:
     """
+    # the state dicts are staged separately, otherwise the optimizer state
+    # loaded from the checkpoint keeps a copy of the weights alive
     data_to_save = {
         'mode': stats.mode,
         'episode': stats.episode,
-        'model_state_dict': model.state_dict(),
-        'optimizer_state_dict': optimizer.state_dict(),
+        'model_state_dict': stage_to_host(model.state_dict()),
+        'optimizer_state_dict': stage_to_host(optimizer.state_dict()),
         'total_val_loss': stats.total_val_loss
     }
 
@@ -387,20 +846,20 @@ def load_model():
     model_dir = os.path.join(config.data_path, "models", "experiment_{}"
                  .format(experiment.number))
     
-    checkpoints = os.listdir(model_dir)
-    checkpoints = [i for i in checkpoints if os.path.splitext(i)[-1] == ".tar"]
-    max_cp = max([int(cp.split(".")[0].split("_")[1]) for cp in checkpoints])
+    max_cp = max(list_checkpoints(model_dir))
     #if experiment.episode == -1, load latest checkpoint
     episode = max_cp if experiment.episode == -1 else experiment.episode
     checkpoint_path = os.path.join(model_dir, f"checkpoint_{episode}.pth.tar")
-    checkpoint = torch.load(checkpoint_path)
+    # tensors are paged in from the file straight onto the device
+    checkpoint = torch.load(checkpoint_path, map_location=get_device(),
+                            mmap=True, weights_only=True)
 
     log_filename = os.path.join(model_dir, "model_log.txt")
     msg = f"\n*********** checkpoint {episode} was loaded **************" 
     log_data(msg, log_filename)
     
     leo = LEO()
-    optimizer = torch.optim.Adam(leo.parameters(), lr=hyp.outer_loop_lr)
+    optimizer = leo.optimizer
     leo.load_state_dict(checkpoint['model_state_dict'])
     optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
     mode = checkpoint['mode']
@@ -1,18 +1,18 @@
 import os
+import re
 import sys
 import pprint
 import pickle
 import json
-import random
 import yaml
 import torch
 import torch.optim as optim
+import torch.distributed as dist
 import torchvision
 import logging
 import logging.config
 import numpy as np
 from PIL import Image
-from matplotlib import pyplot as plt
 from easydict import EasyDict as edict
 from io import StringIO
 
@@ -45,16 +45,26 @@ def meta_classes_selector(config, dataset, shuffle_classes=False):
 
     splits = config.data_params.meta_class_splits
     if dataset in config.datasets:
-        data_path = os.path.join(os.path.dirname(__file__), config.data_path,
-                                 f"{dataset}", "meta_classes.pkl")
+        dataset_path = os.path.join(os.path.dirname(__file__),
+                                    config.data_path, f"{dataset}")
+        data_path = os.path.join(dataset_path, "meta_classes.json")
+        legacy_data_path = os.path.join(dataset_path, "meta_classes.pkl")
         if os.path.exists(data_path):
-            meta_classes_splits = load_pickled_data(data_path)
+            meta_classes_splits = load_json_data(data_path)
+        elif os.path.exists(legacy_data_path):
+            # keep the splits of existing experiments
+            meta_classes_splits = load_pickled_data(legacy_data_path)
+            save_json_data(meta_classes_splits, data_path)
         else:
-            classes = os.listdir(os.path.join(os.path.dirname(__file__),
-                                 "data", f"{dataset}", "images"))
+            images_path = os.path.join(os.path.dirname(__file__),
+                                       "data", f"{dataset}", "images")
+            with os.scandir(images_path) as entries:
+                classes = sorted(entry.name for entry in entries
+                                 if entry.is_dir())
             if shuffle_classes:
-                random.shuffle(classes)
-            
+                rng = np.random.default_rng(config.seed)
+                classes = rng.permutation(classes).tolist()
+
             meta_classes_splits = {"meta_train": extract_splits(classes, splits.meta_train),
                                    "meta_val": extract_splits(classes, splits.meta_val),
                                    "meta_test": extract_splits(classes, splits.meta_test)}
@@ -63,11 +73,7 @@ def meta_classes_selector(config, dataset, shuffle_classes=False):
                               meta_classes_splits["meta_val"] +
                               meta_classes_splits["meta_test"]))
             assert total_count == len(classes), "check ratios supplied"
-            if os.path.exists(data_path):
-                os.remove(data_path)
-                save_pickled_data(meta_classes_splits, data_path)
-            else:
-                save_pickled_data(meta_classes_splits, data_path)
+            save_json_data(meta_classes_splits, data_path)
     return edict(meta_classes_splits)
 
 
@@ -76,21 +82,35 @@ def save_npy(np_array, filename):
     filename = f"{filename}.npy" if len(os.path.splitext(filename)[-1]) == 0\
         else filename
     with open(filename, "wb") as f:
-        return np.save(f, np_array)
+        return np.save(f, np_array, allow_pickle=False)
 
 
 def load_npy(filename):
-    """Reads a npy file"""
+    """Reads a npy file
+    The array is memory mapped read-only, so only the slices that are
+    accessed get read from disk
+    """
     filename = f"{filename}.npy" if len(os.path.splitext(filename)[-1]) == 0\
         else filename
-    with open(filename, "rb") as f:
-        return np.load(f)
+    return np.load(filename, mmap_mode="r", allow_pickle=False)
+
+
+def save_json_data(data, data_path):
+    """Saves a json file"""
+    with open(data_path, "w") as f:
+        json.dump(data, f)
+
+
+def load_json_data(data_path):
+    """Reads a json file"""
+    with open(data_path, "r") as f:
+        return json.load(f)
 
 
 def save_pickled_data(data, data_path):
     """Saves a pickle file"""
     with open(data_path, "wb") as f:
-        data = pickle.dump(data, f)
+        data = pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
     return data
 
 
@@ -101,21 +121,59 @@ def load_pickled_data(data_path):
     return data
 
 
-def numpy_to_tensor(np_data):
-    """Converts numpy array to pytorch tensor"""
-    config = load_config()
-    np_data = np_data.astype(config.dtype)
-    device = torch.device("cuda:0" if torch.cuda.is_available()
-                          and config.use_gpu else "cpu")
-    return torch.from_numpy(np_data).to(device)
+_device = None
+
+
+def get_device():
+    """Returns the torch device set by config, resolved once per process"""
+    global _device
+    if _device is None:
+        _device = torch.device("cuda" if torch.cuda.is_available()
+                               and config.use_gpu else "cpu")
+    return _device
+
 
+_pinned_buffers = {}
 
+
+def pinned_buffer(shape, dtype):
+    """ Returns a reusable pinned host buffer and its copy event
+        The previous copy out of the buffer is awaited before it is reused
+    """
+    key = (tuple(shape), dtype)
+    if key not in _pinned_buffers:
+        _pinned_buffers[key] = (torch.empty(shape, dtype=dtype,
+                                            pin_memory=True),
+                                torch.cuda.Event())
+    buffer, copy_done = _pinned_buffers[key]
+    copy_done.synchronize()
+    return buffer, copy_done
+
+
+def numpy_to_tensor(np_data):
+    """ Converts numpy array to pytorch tensor
+        On cuda the array is staged in a pinned buffer and copied to the
+        device asynchronously. Use this helper for host to device copies
+        rather than calling .pin_memory().to(), which pins a new buffer
+        on every call
+    """
+    if np_data.dtype != np_dtype:
+        np_data = np_data.astype(np_dtype, copy=False)
+    host_tensor = torch.from_numpy(np_data)
+    device = get_device()
+    if device.type != "cuda":
+        return host_tensor
+    staging, copy_done = pinned_buffer(host_tensor.shape, host_tensor.dtype)
+    staging.copy_(host_tensor)
+    tensor = staging.to(device, non_blocking=True)
+    copy_done.record()
+    return tensor
+
+
+@torch.inference_mode()
 def tensor_to_numpy(pytensor):
     """Converts pytorch tensor to numpy"""
-    if pytensor.is_cuda:
-        return pytensor.cpu().detach().numpy()
-    else:
-        return pytensor.detach().numpy()
+    return pytensor.numpy(force=True)
 
 
 def load_yaml(data_path):
@@ -164,6 +222,24 @@ def loggers(config):
     return train_logger, val_logger
 
 
+checkpoint_pattern = re.compile(r"checkpoint_(\d+)\.pth\.tar$")
+
+
+def list_checkpoints(checkpoint_dir):
+    """ Returns the episodes of the checkpoints saved in a directory
+        Args:
+            checkpoint_dir (str): experiment directory
+        Returns:
+            episodes (list): episode numbers, empty if the directory
+                does not exist
+    """
+    if not os.path.isdir(checkpoint_dir):
+        return []
+    with os.scandir(checkpoint_dir) as entries:
+        matches = [checkpoint_pattern.match(entry.name) for entry in entries]
+    return [int(match.group(1)) for match in matches if match]
+
+
 def check_experiment(config):
     """ Checks if the experiment is new or not and
         creates a log file for a new experiment
@@ -173,15 +249,11 @@ def check_experiment(config):
         (bool)
     """
     experiment = config.experiment
-    existing_models = os.listdir(model_root)
     checkpoint_paths = os.path.join(model_root,
                                     f"experiment_{experiment.number}")
-    existing_checkpoints = os.listdir(checkpoint_paths)
-    if f"experiment_{experiment.number}" in existing_models and\
-       f"checkpoint_{experiment.episode}.pth.tar" in existing_checkpoints:
+    if experiment.episode in list_checkpoints(checkpoint_paths):
         return True
-    elif f"experiment_{experiment.number}" in existing_models and\
-         experiment.episode == -1:
+    elif os.path.isdir(checkpoint_paths) and experiment.episode == -1:
         return True
     else:
         create_log(config)
@@ -189,16 +261,24 @@ def check_experiment(config):
 
 
 def prepare_inputs(data):
-    """ change the channel dimension for data
+    """ change the channel dimension for data and place it on the device
         Args:
-            data (tensor): (num_examples_per_class, height, width, channels)
+            data (tensor): ([num_tasks], num_examples_per_class, height,
+                            width, channels)
         Returns:
-            data (tensor): (num_examples_per_class, channels, height, width)
+            data (tensor): ([num_tasks], num_examples_per_class, channels,
+                            height, width)
     """
     if type(data) == list:
         return data
+    device = get_device()
+    if data.device.type != device.type:
+        # permuting only changes strides, move the data before it
+        data = data.to(device, non_blocking=True)
     if len(data.shape) == 4:
         data = data.permute((0, 3, 1, 2))
+    elif len(data.shape) == 5:
+        data = data.permute((0, 1, 4, 2, 3))
     return data
 
 
@@ -212,9 +292,68 @@ def get_named_dict(metadata, batch):
     return edict(data_dict)
 
 
+def is_distributed():
+    """Returns True if running in an initialized process group"""
+    return dist.is_available() and dist.is_initialized()
+
+
+def is_main_process():
+    """Returns True for the process that saves and logs shared data"""
+    return not is_distributed() or dist.get_rank() == 0
+
+
+def shard(sequence):
+    """ Returns the elements of a sequence assigned to this process
+        Elements are dealt round robin across the distributed processes
+        Args:
+            sequence (list): e.g. classes or task indices
+        Returns:
+            shard (list): elements of this process
+    """
+    sequence = list(sequence)
+    if not is_distributed():
+        return sequence
+    return sequence[dist.get_rank()::dist.get_world_size()]
+
+
+def all_reduce_grads(grads):
+    """Sums gradients across the distributed processes in place"""
+    if not is_distributed():
+        return
+    flat_grads = torch.cat([grad.reshape(-1) for grad in grads])
+    dist.all_reduce(flat_grads)
+    for grad, reduced in zip(grads,
+                             flat_grads.split([g.numel() for g in grads])):
+        grad.copy_(reduced.view_as(grad))
+
+
+def average_buffers(buffers):
+    """ Averages floating point buffers across the distributed processes
+        in place, e.g. BatchNorm running statistics
+    """
+    if not is_distributed():
+        return
+    buffers = [buffer for buffer in buffers if buffer.is_floating_point()]
+    flat_buffers = torch.cat([buffer.reshape(-1) for buffer in buffers])
+    dist.all_reduce(flat_buffers)
+    flat_buffers /= dist.get_world_size()
+    for buffer, reduced in zip(buffers, flat_buffers.split(
+            [b.numel() for b in buffers])):
+        buffer.copy_(reduced.view_as(buffer))
+
+
+def broadcast_tensors(tensors):
+    """Copies the tensors of the main process to all other processes"""
+    if not is_distributed():
+        return
+    for tensor in tensors:
+        dist.broadcast(tensor.data, src=0)
+
+
 def log_data(msg, log_filename, overwrite=False):
     """Log data to a file"""
-    mode_ = "w" if not os.path.exists(log_filename) or overwrite else "a"
+    # append mode creates missing files, no existence check needed
+    mode_ = "w" if overwrite else "a"
     msg = msg if overwrite else "\n" + msg
     with open(log_filename, mode_) as f:
         f.write(msg)
@@ -233,29 +372,30 @@ def display_data_shape(metadata):
           f"val_imgs shape: {val_imgs_shape}, val_masks shape: {val_masks_shape}")
 
 
+@torch.inference_mode()
 def calc_iou_per_class(pred_x, targets):
-    """Calculates iou"""
-    iou_per_class = []
-    for i in range(len(pred_x)):
-        pred = np.argmax(tensor_to_numpy(pred_x[i]), 0).astype(int)
-        target = tensor_to_numpy(targets[i]).astype(int)
-        iou = np.sum(np.logical_and(target, pred))/np.sum(np.logical_or(target, pred))
-        iou_per_class.append(iou)
-    mean_iou_per_class = np.mean(iou_per_class)
-    return mean_iou_per_class
-
-
-def plot_masks(mask_data, ground_truth=False):
-    """ plots masks for tensorboard make_grid
+    """ Calculates the mean iou of a batch of predictions on their device
+        Numpy arrays are also accepted and evaluated on the host
         Args:
-            mask_data(torch.Tensor) - mask data
-            ground_truth(bool) - True if mask is a groundtruth else
-                it is a prediction
+            pred_x (torch.Tensor): predicted logits (batch, 2, height, width)
+            targets (torch.Tensor): masks (batch, height, width)
+        Returns:
+            mean_iou (torch.Tensor): iou averaged over the batch, a 0-d
+                tensor on the device of the predictions. A float for numpy
+                inputs
     """
-    if ground_truth:
-        plt.imshow(np.mean(mask_data.numpy(), 0)/2 + 0.5, cmap="gray")
-    else:
-        plt.imshow(np.mean(mask_data.numpy())/2 + 0.5, cmap="gray")
+    if not torch.is_tensor(pred_x):
+        ious = np.empty(len(pred_x), dtype=np.float64)
+        for i in range(len(pred_x)):
+            pred = np.argmax(pred_x[i], 0).astype(bool)
+            target = np.asarray(targets[i]).astype(bool)
+            ious[i] = np.sum(pred & target)/np.sum(pred | target)
+        return ious.mean()
+    pred = pred_x.argmax(dim=1).bool()
+    target = targets.bool()
+    intersection = (pred & target).flatten(1).sum(1).float()
+    union = (pred | target).flatten(1).sum(1).float()
+    return (intersection/union).mean()
 
 
 def print_to_string_io(variable_to_print, pretty_print=True, logger=None):
@@ -276,6 +416,7 @@ def print_to_string_io(variable_to_print, pretty_print=True, logger=None):
 
 project_root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 config = load_config()
+np_dtype = np.dtype(config.dtype)
 model_root = os.path.join(project_root, "leo_segmentation",
                           config.data_path, "models")
 model_dir = os.path.join(model_root, "experiment_{}".
@@ -2,15 +2,18 @@ import sys
 import os
 import argparse
 import time
+import random
 import torch
 import torch.optim
+import torch.distributed as dist
 import numpy as np
 from easydict import EasyDict as edict
 from leo_segmentation.data import Datagenerator, TrainingStats
 from leo_segmentation.model import LEO, load_model, save_model
 from leo_segmentation.utils import load_config, check_experiment,\
     get_named_dict, log_data, load_yaml, train_logger, val_logger, \
-    print_to_string_io, save_pickled_data, model_dir
+    print_to_string_io, save_pickled_data, model_dir, is_main_process,\
+    get_device
 
 try:
     shell = get_ipython().__class__.__name__
@@ -39,8 +42,7 @@ def train_model(config, dataset):
     """Trains Model"""
     # writer = SummaryWriter(os.path.join(config.data_path, "models",
     # str(config.experiment.number)))
-    device = torch.device("cuda:0" if torch.cuda.is_available()
-                          and config.use_gpu else "cpu")
+    device = get_device()
     if check_experiment(config):
         # Load saved model and parameters
         leo, optimizer, train_stats = load_model_and_params()
@@ -62,8 +64,8 @@ def train_model(config, dataset):
         metadata = dataloader.get_batch_data()
         transformers = (dataloader.transform_image, dataloader.transform_mask)
         _, train_stats = leo.compute_loss(metadata, train_stats, transformers)
-        if episode % config.checkpoint_interval == 0:
-            save_model(leo, optimizer, config,
+        if episode % config.checkpoint_interval == 0 and is_main_process():
+            save_model(leo, leo.optimizer, config,
                        edict(train_stats.get_latest_stats()))
         # meta-val stage
         if episode % config.meta_val_interval == 0:
@@ -96,6 +98,8 @@ def predict_model(dataset, model_and_params, transformers):
     _, train_stats = leo.compute_loss(metadata, train_stats, transformers,
                                       mode="meta_test")
     train_stats.disp_stats()
+    if not is_main_process():
+        return leo
     experiment = config.experiment
     for mode in ["meta_train", "meta_val", "meta_test"]:
         stats_df = train_stats.get_stats(mode)
@@ -111,7 +115,21 @@ def predict_model(dataset, model_and_params, transformers):
     return leo
 
 
+def init_distributed():
+    """ Joins the process group when launched with torchrun
+        Every process samples its own tasks, hence the random generators
+        are seeded with a rank offset
+    """
+    if int(os.environ.get("WORLD_SIZE", 1)) > 1:
+        torch.cuda.set_device(int(os.environ["LOCAL_RANK"]))
+        dist.init_process_group("nccl")
+        seed = config.seed + dist.get_rank()
+        random.seed(seed)
+        np.random.seed(seed)
+
+
 def main():
+    init_distributed()
     if config.train:
         train_model(config, dataset)
     else:
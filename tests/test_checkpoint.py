@@ -0,0 +1,56 @@
+import io
+import pytest
+
+torch = pytest.importorskip("torch")
+from torch import nn
+from leo_segmentation.model import stage_to_host
+
+
+def build(memory_format):
+    model = nn.Sequential(nn.Conv2d(3, 4, 3), nn.BatchNorm2d(4))\
+        .cuda().to(memory_format=memory_format)
+    optimizer = torch.optim.Adam(model.parameters(), fused=True)
+    return model, optimizer
+
+
+def train_step(model, optimizer, memory_format):
+    inputs = torch.randn(2, 3, 8, 8, device="cuda")\
+        .contiguous(memory_format=memory_format)
+    optimizer.zero_grad(set_to_none=True)
+    model(inputs).sum().backward()
+    optimizer.step()
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(),
+                    reason="only cuda tensors are staged")
+@pytest.mark.parametrize("memory_format",
+                         [torch.contiguous_format, torch.channels_last])
+def test_staged_checkpoint_round_trip(memory_format):
+    """ A staged checkpoint with float and int64 tensors saves and loads
+        with the layout of the saved tensors and training resumes from it
+    """
+    model, optimizer = build(memory_format)
+    train_step(model, optimizer, memory_format)
+    data_to_save = {
+        'model_state_dict': stage_to_host(model.state_dict()),
+        'optimizer_state_dict': stage_to_host(optimizer.state_dict()),
+    }
+    checkpoint_file = io.BytesIO()
+    torch.save(data_to_save, checkpoint_file)
+    checkpoint_file.seek(0)
+    checkpoint = torch.load(checkpoint_file, map_location="cuda",
+                            weights_only=True)
+
+    loaded_model, loaded_optimizer = build(memory_format)
+    loaded_model.load_state_dict(checkpoint['model_state_dict'])
+    loaded_optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+    for key, value in model.state_dict().items():
+        assert torch.equal(loaded_model.state_dict()[key], value)
+    loaded_state = loaded_optimizer.state_dict()['state']
+    for param_id, param_state in optimizer.state_dict()['state'].items():
+        for key, value in param_state.items():
+            loaded_value = loaded_state[param_id][key]
+            assert torch.equal(loaded_value.cpu(), value.cpu())
+            assert loaded_value.stride() == value.stride()
+    # the fused optimizer needs the states in the layout of the parameters
+    train_step(loaded_model, loaded_optimizer, memory_format)